@@ -5,103 +5,161 @@ from vhotplug.device import *
 
 logger = logging.getLogger("vhotplug")
 
+def casefold_id(value):
+    return value.casefold() if value else None
+
 class Config:
     def __init__(self, path):
         self.path = path
         self.config = self.load()
+        self.usb_rules = self.compile_usb_rules()
+        self.index_usb_rules()
 
     def load(self):
         with open(self.path, 'r') as file:
             return json.load(file)
 
+    def compile_pattern(self, pattern):
+        if not pattern:
+            return None
+        try:
+            return re.compile(pattern, re.IGNORECASE)
+        except re.error as e:
+            logger.error("Invalid regular expression %s in the configuration file: %s", pattern, e)
+            return None
+
+    def compile_usb_rules(self):
+        # Everything that does not depend on the device is prepared once
+        rules = []
+        for vm in self.config.get("vms", []):
+            for usb in vm.get("usbPassthrough", []):
+                if usb.get("disable") == True:
+                    continue
+                ignore = []
+                for dev in usb.get("ignore", []):
+                    if dev.get("disable") == True:
+                        continue
+                    ignore_vid = casefold_id(dev.get("vendorId"))
+                    ignore_pid = casefold_id(dev.get("productId"))
+                    if ignore_vid and ignore_pid:
+                        ignore.append((ignore_vid, ignore_pid, dev.get("description")))
+                rules.append({
+                    "vm": vm,
+                    "usb": usb,
+                    "vendorId": casefold_id(usb.get("vendorId")),
+                    "productId": casefold_id(usb.get("productId")),
+                    "vendorName": self.compile_pattern(usb.get("vendorName")),
+                    "productName": self.compile_pattern(usb.get("productName")),
+                    "ignore": ignore
+                })
+        return rules
+
+    def index_usb_rules(self):
+        # Rule numbers by the attribute they can match on, a rule that is not
+        # indexed under the device attributes can't match the device
+        self.usb_rules_by_id = {}
+        self.usb_rules_by_class = {}
+        self.usb_rules_by_name = []
+        for i, rule in enumerate(self.usb_rules):
+            if rule["vendorId"] and rule["productId"]:
+                self.usb_rules_by_id.setdefault((rule["vendorId"], rule["productId"]), []).append(i)
+            if rule["vendorName"] or rule["productName"]:
+                self.usb_rules_by_name.append(i)
+            usb_class = rule["usb"].get("class")
+            if usb_class:
+                self.usb_rules_by_class.setdefault(usb_class, []).append(i)
+
+    def usb_rule_candidates(self, vid_cf, pid_cf, usb_interfaces):
+        candidates = set(self.usb_rules_by_name)
+        candidates.update(self.usb_rules_by_id.get((vid_cf, pid_cf), ()))
+        for interface in usb_interfaces:
+            candidates.update(self.usb_rules_by_class.get(interface["class"], ()))
+        # Rules are checked in the configuration file order
+        return [self.usb_rules[i] for i in sorted(candidates)]
+
     def vm_for_usb_device(self, vid, pid, vendor_name, product_name, interfaces):
         try:
-            logger.debug(f"Searching for a VM for {vid}:{pid}, {vendor_name}:{product_name}")
-            for vm in self.config.get("vms", []):
+            logger.debug("Searching for a VM for %s:%s, %s:%s", vid, pid, vendor_name, product_name)
+            vid_cf = casefold_id(vid)
+            pid_cf = casefold_id(pid)
+            usb_interfaces = parse_usb_interfaces(interfaces)
+            for rule in self.usb_rule_candidates(vid_cf, pid_cf, usb_interfaces):
+                vm = rule["vm"]
+                usb = rule["usb"]
                 vm_name = vm.get("name")
-                for usb in vm.get("usbPassthrough", []):
-                    matches = False
+                matches = False
 
-                    if usb.get("disable") == True:
-                        continue
+                # Find a VM by VID/PID
+                usb_vid = rule["vendorId"]
+                usb_pid = rule["productId"]
+                usb_description = usb.get("description")
+                logger.debug("Rule %s", usb_description)
+                logger.debug("Checking %s:%s against %s:%s", vid, pid, usb_vid, usb_pid)
+                vidMatch = usb_vid and vid_cf == usb_vid
+                pidMatch = usb_pid and pid_cf == usb_pid
+                if vidMatch and pidMatch:
+                    logger.info("Found VM %s by vendor id / product id, description: %s", vm_name, usb_description)
+                    matches = True
 
-                    # Find a VM by VID/PID
-                    usb_vid = usb.get("vendorId")
-                    usb_pid = usb.get("productId")
-                    usb_description = usb.get("description")
-                    logger.debug(f"Rule {usb_description}")
-                    logger.debug(f"Checking {vid}:{pid} against {usb_vid}:{usb_pid}")
-                    vidMatch = usb_vid and vid.casefold() == usb_vid.casefold()
-                    pidMatch = usb_pid and pid.casefold() == usb_pid.casefold()
-                    if vidMatch and pidMatch:
-                        logger.info(f"Found VM {vm_name} by vendor id / product id, description: {usb_description}")
+                # Find a VM by vendor name / product name
+                if not matches:
+                    usb_vname = rule["vendorName"]
+                    usb_pname = rule["productName"]
+                    logger.debug("Checking %s:%s against %s:%s", vendor_name, product_name, usb.get('vendorName'), usb.get('productName'))
+                    vnameMatch = usb_vname and vendor_name is not None and usb_vname.match(vendor_name)
+                    pnameMatch = usb_pname and product_name is not None and usb_pname.match(product_name)
+                    if vnameMatch or pnameMatch:
+                        logger.info("Found VM %s by vendor name / product name, description: %s", vm_name, usb_description)
                         matches = True
 
-                    # Find a VM by vendor name / product name
-                    if not matches:
-                        usb_vname = usb.get("vendorName")
-                        usb_pname = usb.get("productName")
-                        logger.debug(f"Checking {vendor_name}:{product_name} against {usb_vname}:{usb_pname}")
-                        vnameMatch = usb_vname and re.match(usb_vname, vendor_name, re.IGNORECASE)
-                        pnameMatch = usb_pname and re.match(usb_pname, product_name, re.IGNORECASE)
-                        if vnameMatch or pnameMatch:
-                            logger.info(f"Found VM {vm_name} by vendor name / product name, description: {usb_description}")
-                            matches = True
-
-                    # Find a VM by interface class, subclass and protocol
-                    if not matches:
-                        usb_class = usb.get("class")
-                        usb_subclass = usb.get("subclass")
-                        usb_protocol = usb.get("protocol")
-                        usb_interfaces = parse_usb_interfaces(interfaces)
-                        for interface in usb_interfaces:
-                            interface_class = interface["class"]
-                            interface_subclass = interface["subclass"]
-                            interface_protocol = interface["protocol"]
-                            logger.debug(f"Checking class {interface_class}, subclass {interface_subclass}, protocol: {interface_protocol}")
-                            if usb_class and usb_class == interface_class:
-                                subclassMatch = not usb_subclass or usb_subclass == interface_subclass
-                                protocolMatch = not usb_protocol or usb_protocol == interface_protocol
-                                if subclassMatch and protocolMatch:
-                                    logger.info(f"Found VM {vm_name} by USB interface class, description: {usb_description}")
-                                    matches = True
-                                    break
-
-                    # Check ignored devices
-                    if matches:
-                        ignore = False
-                        for dev in usb.get("ignore", []):
-                            if dev.get("disable") == True:
-                                continue
-                            ignore_vid = dev.get("vendorId")
-                            ignore_pid = dev.get("productId")
-                            ignore_description = dev.get("description")
-                            if (vid and pid) and (vid.casefold() == ignore_vid.casefold()) and (pid.casefold() == ignore_pid.casefold()):
-                                logger.info(f"Device {vid}:{pid} is ignored, description: {ignore_description}")
-                                ignore = True
+                # Find a VM by interface class, subclass and protocol
+                if not matches:
+                    usb_class = usb.get("class")
+                    usb_subclass = usb.get("subclass")
+                    usb_protocol = usb.get("protocol")
+                    for interface in usb_interfaces:
+                        interface_class = interface["class"]
+                        interface_subclass = interface["subclass"]
+                        interface_protocol = interface["protocol"]
+                        logger.debug("Checking class %s, subclass %s, protocol: %s", interface_class, interface_subclass, interface_protocol)
+                        if usb_class and usb_class == interface_class:
+                            subclassMatch = not usb_subclass or usb_subclass == interface_subclass
+                            protocolMatch = not usb_protocol or usb_protocol == interface_protocol
+                            if subclassMatch and protocolMatch:
+                                logger.info("Found VM %s by USB interface class, description: %s", vm_name, usb_description)
+                                matches = True
                                 break
 
-                        if not ignore:
-                            return vm
+                # Check ignored devices
+                if matches:
+                    ignore = False
+                    for ignore_vid, ignore_pid, ignore_description in rule["ignore"]:
+                        if vid_cf == ignore_vid and pid_cf == ignore_pid:
+                            logger.info("Device %s:%s is ignored, description: %s", vid, pid, ignore_description)
+                            ignore = True
+                            break
+
+                    if not ignore:
+                        return vm
 
         except Exception as e:
-                logger.error(f"Failed to find VM for USB device in the configuration file: {e}")
+                logger.error("Failed to find VM for USB device in the configuration file: %s", e)
         return None
 
     def vm_for_evdev_devices(self):
         try:
-            logger.debug(f"Searching for a VM for evdev passthrough")
+            logger.debug("Searching for a VM for evdev passthrough")
             for vm in self.config.get("vms", []):
                 vm_name = vm.get("name")
                 evdev = vm.get("evdevPassthrough")
                 if evdev:
                     enable = evdev.get("enable")
                     if enable:
-                        logger.debug(f"Found VM {vm_name} for evdev passthrough")
+                        logger.debug("Found VM %s for evdev passthrough", vm_name)
                         bus_prefix = evdev.get("pcieBusPrefix")
                         return vm, bus_prefix
         except Exception as e:
-            logger.error(f"Failed to find VM for evdev device in the configuration file: {e}")
+            logger.error("Failed to find VM for evdev device in the configuration file: %s", e)
         return None
 
     def get_all_vms(self):
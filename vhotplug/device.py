@@ -1,5 +1,7 @@
 import logging
+import asyncio
 import fcntl
+import os
 import struct
 import psutil
 from vhotplug.qemulink import *
@@ -9,45 +11,90 @@ EVIOCGNAME = 0x82004506
 
 logger = logging.getLogger("vhotplug")
 
+# Per-device lookups that are stable for the lifetime of a device
+_usb_parent_cache = {}
+_evdev_name_cache = {}
+_input_device_cache = {}
+
+def _read_sysfs_attributes(sys_path):
+    attributes = {}
+    try:
+        entries = os.scandir(sys_path)
+    except FileNotFoundError:
+        # The device is already gone, e.g. on remove events
+        return attributes
+    with entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                try:
+                    with open(entry.path, 'rb') as file:
+                        attributes[entry.name] = file.read().rstrip()
+                except OSError:
+                    pass
+    return attributes
+
 def log_device(device, level=logging.DEBUG):
+    if not logger.isEnabledFor(level):
+        return
     try:
-        logger.log(level, f"Device path: {device.device_path}")
-        logger.log(level, f"  sys_path: {device.sys_path}")
-        logger.log(level, f"  sys_name: {device.sys_name}")
-        logger.log(level, f"  sys_number: {device.sys_number}")
-        logger.log(level, f"  tags:")
+        logger.log(level, "Device path: %s", device.device_path)
+        logger.log(level, "  sys_path: %s", device.sys_path)
+        logger.log(level, "  sys_name: %s", device.sys_name)
+        logger.log(level, "  sys_number: %s", device.sys_number)
+        logger.log(level, "  tags:")
         for t in device.tags:
             if t:
-                logger.log(level, f"    {t}")
-        logger.log(level, f"  subsystem: {device.subsystem}")
-        logger.log(level, f"  driver: {device.driver}")
-        logger.log(level, f"  device_type: {device.device_type}")
-        logger.log(level, f"  device_node: {device.device_node}")
-        logger.log(level, f"  device_number: {device.device_number}")
-        logger.log(level, f"  is_initialized: {device.is_initialized}")
+                logger.log(level, "    %s", t)
+        logger.log(level, "  subsystem: %s", device.subsystem)
+        logger.log(level, "  driver: %s", device.driver)
+        logger.log(level, "  device_type: %s", device.device_type)
+        logger.log(level, "  device_node: %s", device.device_node)
+        logger.log(level, "  device_number: %s", device.device_number)
+        logger.log(level, "  is_initialized: %s", device.is_initialized)
         logger.log(level, "  Device properties:")
-        for i in device.properties:
-            logger.log(level, f"    {i} = {device.properties[i]}")
+        for name, value in device.properties.items():
+            logger.log(level, "    %s = %s", name, value)
         logger.log(level, "  Device attributes:")
-        for a in device.attributes.available_attributes:
-            logger.log(level, f"    {a}: {device.attributes.get(a)}")
-    except AttributeError as e:
+        for name, value in _read_sysfs_attributes(device.sys_path).items():
+            logger.log(level, "    %s: %s", name, value)
+    except (AttributeError, OSError) as e:
         logger.warn(e)
 
 def is_usb_device(device):
     return device.subsystem == "usb" and device.device_type == "usb_device"
 
 def find_usb_parent(device):
-    return device.find_parent(subsystem="usb", device_type="usb_device")
+    parent = _usb_parent_cache.get(device.sys_path)
+    if parent is None:
+        parent = device.find_parent(subsystem="usb", device_type="usb_device")
+        if parent is not None:
+            _usb_parent_cache[device.sys_path] = parent
+    return parent
+
+def forget_device(device):
+    _usb_parent_cache.pop(device.sys_path, None)
+    _input_device_cache.pop(device.sys_path, None)
+    if device.device_node:
+        _evdev_name_cache.pop(device.device_node, None)
 
 def is_input_device(device):
-    if device.subsystem == "input" and device.sys_name.startswith("event") and device.properties.get("ID_INPUT") == "1":
-        return device.properties.get("ID_INPUT_MOUSE") == "1" or \
-            (device.properties.get("ID_INPUT_KEYBOARD") == "1") or \
-            (device.properties.get("ID_INPUT_TOUCHPAD") == "1") or \
-            (device.properties.get("ID_INPUT_TOUCHSCREEN") == "1") or \
-            (device.properties.get("ID_INPUT_TABLET") == "1")
-    return False
+    result = _input_device_cache.get(device.sys_path)
+    if result is None:
+        result = _is_input_device(device)
+        _input_device_cache[device.sys_path] = result
+    return result
+
+def _is_input_device(device):
+    if device.subsystem != "input" or not device.sys_name.startswith("event"):
+        return False
+    prop = device.properties.get
+    if prop("ID_INPUT") != "1":
+        return False
+    return prop("ID_INPUT_MOUSE") == "1" or \
+        (prop("ID_INPUT_KEYBOARD") == "1") or \
+        (prop("ID_INPUT_TOUCHPAD") == "1") or \
+        (prop("ID_INPUT_TOUCHSCREEN") == "1") or \
+        (prop("ID_INPUT_TABLET") == "1")
 
 def is_sound_device(device):
     return device.subsystem == "sound" and device.device_type != "pcm" and device.sys_name.startswith("card")
@@ -56,93 +103,128 @@ def is_disk_device(device):
     return device.subsystem == "block" and device.device_type == "disk"
 
 def is_network_device(device):
+    if device.subsystem != "net" or device.device_type == "bridge" or device.sys_name == "lo":
+        return False
     driver = device.properties.get("ID_NET_DRIVER")
-    return device.subsystem == "net" and device.device_type != "bridge" and \
-        driver != "tun" and driver != "bridge" and device.sys_name != "lo"
+    return driver != "tun" and driver != "bridge"
 
 def is_smartcard(device):
     return device.subsystem == "usb" and device.properties.get("ID_SMARTCARD_READER") == "1"
 
-def get_evdev_name(device):
+def _read_evdev_name(device_node):
+    fd = os.open(device_node, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+    try:
+        name = bytearray(256)
+        fcntl.ioctl(fd, EVIOCGNAME, name) #EVIOCGNAME
+        return name.split(b'\x00', 1)[0].decode('utf-8')
+    finally:
+        os.close(fd)
+
+def _try_grab(device_node):
+    fd = os.open(device_node, os.O_WRONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+    try:
+        fcntl.ioctl(fd, EVIOCGRAB, struct.pack('i', 1))
+    except OSError as e:
+        logger.debug(e)
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+async def get_evdev_name(device):
     if device.device_node:
-        with open(device.device_node, 'rb') as dev:
-            name = bytearray(256)
-            fcntl.ioctl(dev, EVIOCGNAME, name) #EVIOCGNAME
-            return name.split(b'\x00', 1)[0].decode('utf-8')
+        name = _evdev_name_cache.get(device.device_node)
+        if name is None:
+            # The ioctls are blocking, keep them off the event loop
+            loop = asyncio.get_running_loop()
+            name = await loop.run_in_executor(None, _read_evdev_name, device.device_node)
+            _evdev_name_cache[device.device_node] = name
+        return name
     else:
         return None
 
 async def test_grab(device):
-    with open(device.device_node, 'wb') as dev:
-        try:
-            fcntl.ioctl(dev, EVIOCGRAB, struct.pack('i', 1))
-        except OSError as e:
-            logger.debug(e)
-            return True
-    return False
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _try_grab, device.device_node)
 
-def is_boot_device(context, device):
-    # Find device partitions
+def get_boot_devices(context):
+    # Find partitions of USB drives
+    partitions = {}
     for udevpart in context.list_devices(subsystem="block", DEVTYPE="partition"):
-        parent = udevpart.find_parent("usb", "usb_device")
-        if parent and parent.device_node == device.device_node:
-            logger.info(f"USB drive {device.device_node} has partition {udevpart.device_node}")
-            # Find mountpoints
-            partitions = psutil.disk_partitions(all=True)
-            for part in partitions:
-                if part.device == udevpart.device_node:
-                    logger.info(f"Found mountpoint {part.mountpoint} with filesystem {part.fstype}")
-                    logger.info(f"Options: {part.opts}")
-                    if part.mountpoint == "/boot":
-                        return True
-    return False
+        parent = find_usb_parent(udevpart)
+        if parent and parent.device_node:
+            partitions[udevpart.device_node] = parent.device_node
+    if not partitions:
+        return {}
+
+    # Find /boot mountpoints, only the checked device is logged
+    boot_devices = {}
+    for part in psutil.disk_partitions(all=True):
+        if part.mountpoint == "/boot":
+            usb_node = partitions.get(part.device)
+            if usb_node:
+                boot_devices[usb_node] = part
+    return boot_devices
+
+def is_boot_device(context, device, boot_devices=None):
+    if boot_devices is None:
+        boot_devices = get_boot_devices(context)
+    part = boot_devices.get(device.device_node)
+    if part is None:
+        return False
+    logger.info("USB drive %s has partition %s", device.device_node, part.device)
+    logger.info("Found mountpoint %s with filesystem %s", part.mountpoint, part.fstype)
+    logger.info("Options: %s", part.opts)
+    return True
 
 def get_usb_info(device):
-    vid = device.properties.get("ID_VENDOR_ID")
-    pid = device.properties.get("ID_MODEL_ID")
-    vendor_name = device.properties.get("ID_VENDOR_FROM_DATABASE")
+    prop = device.properties.get
+    vid = prop("ID_VENDOR_ID")
+    pid = prop("ID_MODEL_ID")
+    vendor_name = prop("ID_VENDOR_FROM_DATABASE")
     if not vendor_name:
-        vendor_name = device.properties.get("ID_VENDOR")
-    product_name = device.properties.get("ID_MODEL_FROM_DATABASE")
+        vendor_name = prop("ID_VENDOR")
+    product_name = prop("ID_MODEL_FROM_DATABASE")
     if not product_name:
-        product_name = device.properties.get("ID_MODEL")
-    interfaces = device.properties.get("ID_USB_INTERFACES")
+        product_name = prop("ID_MODEL")
+    interfaces = prop("ID_USB_INTERFACES")
     return vid, pid, vendor_name, product_name, interfaces
 
-async def attach_usb_device(context, config, device):
+async def attach_usb_device(context, config, device, boot_devices=None):
     vid, pid, vendor_name, product_name, interfaces = get_usb_info(device)
     vm = config.vm_for_usb_device(vid, pid, vendor_name, product_name, interfaces)
     if vm:
         vm_name = vm.get("name")
         qmp_socket = vm.get("qmpSocket")
-        logger.info(f"Attaching to {vm_name} ({qmp_socket})")
-        if is_boot_device(context, device):
-            logger.info(f"USB drive {device.device_node} is used as a boot device, skipping")
+        logger.info("Attaching to %s (%s)", vm_name, qmp_socket)
+        if is_boot_device(context, device, boot_devices):
+            logger.info("USB drive %s is used as a boot device, skipping", device.device_node)
             return
-        qemu = QEMULink(qmp_socket)
+        qemu = QEMULink.get(qmp_socket)
         await qemu.add_usb_device_by_vid_pid(device, int(vid, 16), int(pid, 16))
     else:
-        logger.info(f"No VM found for {vid}:{pid}")
+        logger.info("No VM found for %s:%s", vid, pid)
 
 async def remove_usb_device(config, device):
+    qemuid = None
     for vm in config.get_all_vms():
         vm_name = vm.get("name")
         qmp_socket = vm.get("qmpSocket")
-        logger.debug(f"Checking {vm_name} ({qmp_socket})")
-        qemu = QEMULink(qmp_socket)
+        logger.debug("Checking %s (%s)", vm_name, qmp_socket)
+        qemu = QEMULink.get(qmp_socket)
         ids = await qemu.usb()
-        qemuid = qemu.id_for_usb(device)
+        if qemuid is None:
+            qemuid = qemu.id_for_usb(device)
         if qemuid in ids:
-            logger.info(f"Removing {qemuid} from {vm_name} ({qmp_socket})")
-            qemu = QEMULink(qmp_socket)
-            await qemu.remove_usb_device(device)
+            logger.info("Removing %s from %s (%s)", qemuid, vm_name, qmp_socket)
+            await qemu.remove_usb_device(device, qemuid)
 
 async def attach_evdev_device(vm, busprefix, pcieport, device):
     vm_name = vm.get("name")
     qmp_socket = vm.get("qmpSocket")
     bus = f"{busprefix}{pcieport}"
-    logger.info(f"Attaching evdev device to {vm_name} ({qmp_socket}) on bus {bus}")
-    qemu = QEMULink(qmp_socket)
+    logger.info("Attaching evdev device to %s (%s) on bus %s", vm_name, qmp_socket, bus)
+    qemu = QEMULink.get(qmp_socket)
     await qemu.add_evdev_device(device, bus)
 
 def parse_usb_interfaces(interfaces):
@@ -162,7 +244,7 @@ def parse_usb_interfaces(interfaces):
                         "protocol": int(usb_protocol, 16)
                     })
         except Exception as e:
-            logger.error(f"Failed to parse USB interfaces: {e}")
+            logger.error("Failed to parse USB interfaces: %s", e)
     return result
 
 def is_usb_hub(interfaces):
@@ -176,33 +258,43 @@ def is_usb_hub(interfaces):
 async def attach_connected_devices(context, config):
     # Non-USB evdev passthrough
     res = config.vm_for_evdev_devices()
+    pcieport = 1
+    evdev_tasks = []
+    usb_tasks = []
+    boot_devices = get_boot_devices(context)
+
+    # Enumerate USB devices and, if evdev passthrough is enabled, input devices in a single pass
+    enumerator = context.list_devices(subsystem='usb', DEVTYPE='usb_device')
     if res:
         vm = res[0]
         busprefix = res[1]
-        pcieport = 1
-        logger.info("Checking connected non-USB input devices")
-        for device in context.list_devices(subsystem='input'):
+        enumerator.match_subsystem('input').match_property('ID_INPUT', '1')
+        logger.info("Checking connected USB and non-USB input devices")
+    else:
+        logger.info("Checking connected USB devices")
+
+    for device in enumerator:
+        if device.subsystem == 'input':
             bus = device.properties.get("ID_BUS")
             if is_input_device(device) and bus != "usb":
-                name = get_evdev_name(device)
-                logger.info(f"Found non-USB input device: {name}")
-                logger.info(f"Bus: {bus}, node: {device.device_node}")
+                name = await get_evdev_name(device)
+                logger.info("Found non-USB input device: %s", name)
+                logger.info("Bus: %s, node: %s", bus, device.device_node)
                 log_device(device)
                 if await test_grab(device):
                     logger.info("The device is grabbed by another process, it is likely already connected to the VM")
                 else:
-                    await attach_evdev_device(vm, busprefix, pcieport, device)
+                    evdev_tasks.append(attach_evdev_device(vm, busprefix, pcieport, device))
                     pcieport += 1
-
-    # Check USB devices
-    logger.info("Checking connected USB devices")
-    for device in context.list_devices(subsystem='usb'):
-        if is_usb_device(device):
+        elif is_usb_device(device):
             vid, pid, vendor_name, product_name, interfaces = get_usb_info(device)
-            logger.info(f"Found USB device {vid}:{pid}: {device.device_node}")
-            logger.info(f'Vendor: "{vendor_name}", product: "{product_name}", interfaces: "{interfaces}"')
+            logger.info("Found USB device %s:%s: %s", vid, pid, device.device_node)
+            logger.info('Vendor: "%s", product: "%s", interfaces: "%s"', vendor_name, product_name, interfaces)
             log_device(device)
             if is_usb_hub(interfaces):
-                logger.info(f"USB device {vid}:{pid} is a USB hub, skipping")
+                logger.info("USB device %s:%s is a USB hub, skipping", vid, pid)
                 continue
-            await attach_usb_device(context, config, device)
+            usb_tasks.append(attach_usb_device(context, config, device, boot_devices))
+
+    await asyncio.gather(*evdev_tasks)
+    await asyncio.gather(*usb_tasks)
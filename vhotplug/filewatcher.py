@@ -8,15 +8,16 @@ class FileWatcher:
     def __init__(self):
         self.inotify = INotify()
         self.watch_descriptors = {}
+        self.directory_wds = {}
+
+    def fileno(self):
+        return self.inotify.fileno()
 
     def directory_monitored(self, directory_name):
-        return any(desc['directory'] == directory_name for desc in self.watch_descriptors.values())
+        return directory_name in self.directory_wds
 
     def get_directory_wd(self, directory_name):
-        for wd, desc in self.watch_descriptors.items():
-            if desc['directory'] == directory_name:
-                return wd
-        return None
+        return self.directory_wds.get(directory_name)
 
     def add_file(self, file_path):
         directory = os.path.dirname(file_path)
@@ -30,6 +31,7 @@ class FileWatcher:
                 'directory': directory,
                 'files': set()
             }
+            self.directory_wds[directory] = wd
 
         wd = self.get_directory_wd(directory)
         if wd == None:
@@ -1,18 +1,128 @@
-from qemu.qmp import QMPClient
+from qemu.qmp import QMPClient, QMPError, ConnectError, ExecuteError, ExecInterruptedError, StateError, Runstate
 import logging
 import asyncio
+import random
 import re
 
 logger = logging.getLogger("vhotplug")
 
+usb_id_pattern = re.compile(r',\sID:\s([\w.-]+)')
+
+def _is_duplicate_id(e):
+    return isinstance(e, ExecuteError) and e.error_class == "GenericError" and \
+        str(e).startswith("Duplicate device ID")
+
+def _is_device_busy(e):
+    return isinstance(e, ExecuteError) and e.error_class == "GenericError" and \
+        str(e).endswith("Device or resource busy")
+
+def _is_device_not_found(e):
+    return isinstance(e, ExecuteError) and e.error_class == "DeviceNotFound"
+
+def _is_vm_unavailable(e):
+    # There is no QEMU listening on the socket, retrying will not help
+    return isinstance(e, ConnectError) and isinstance(e.exc, (FileNotFoundError, ConnectionRefusedError))
+
 class QEMULink:
-    retry_count = 5
-    retry_timeout = 1
+    # Shared links by socket path
+    _links = {}
 
-    def __init__(self, socket_path):
+    def __init__(self, socket_path, retry_count=5, retry_timeout=0.25, retry_max_timeout=4, command_timeout=5):
         self.socket_path = socket_path
+        self.command_timeout = command_timeout
+        self.retry_count = retry_count
+        self.retry_timeout = retry_timeout
+        self.retry_max_timeout = retry_max_timeout
+        self._qmp = None
+        self._connect_lock = asyncio.Lock()
+
+    @classmethod
+    def get(cls, socket_path):
+        # Methods are safe to call from concurrent tasks on a shared link
+        link = cls._links.get(socket_path)
+        if link is None:
+            link = cls(socket_path)
+            cls._links[socket_path] = link
+        return link
+
+    @classmethod
+    async def close_all(cls):
+        for link in cls._links.values():
+            await link.aclose()
+
+    async def _conn(self):
+        async with self._connect_lock:
+            if self._qmp is None or self._qmp.runstate != Runstate.RUNNING:
+                await self._drop()
+                qmp = QMPClient()
+                try:
+                    await asyncio.wait_for(qmp.connect(self.socket_path), self.command_timeout)
+                except asyncio.TimeoutError:
+                    await qmp.disconnect()
+                    raise
+                self._qmp = qmp
+            return self._qmp
+
+    async def _drop(self):
+        qmp = self._qmp
+        self._qmp = None
+        if qmp is not None:
+            # disconnect() re-raises the error that ended the session
+            try:
+                await qmp.disconnect()
+            except Exception as e:
+                logger.debug("Closed QMP connection to %s with error: %s", self.socket_path, e)
+
+    async def _drop_if_current(self, qmp):
+        async with self._connect_lock:
+            if self._qmp is qmp:
+                await self._drop()
+
+    async def _execute(self, cmd, args=None):
+        qmp = await self._conn()
+        try:
+            return await asyncio.wait_for(qmp.execute(cmd, args), self.command_timeout)
+        except asyncio.TimeoutError:
+            # QEMU is not responding, start over with a new connection next time
+            await self._drop_if_current(qmp)
+            raise asyncio.TimeoutError(f"No response to {cmd} within {self.command_timeout} seconds")
+        except (ExecInterruptedError, StateError, OSError, EOFError) as e:
+            # The connection is broken, e.g. the VM was restarted, reconnect once
+            logger.debug("QMP connection to %s failed: %s, reconnecting", self.socket_path, e)
+            await self._drop_if_current(qmp)
+            qmp = await self._conn()
+            return await asyncio.wait_for(qmp.execute(cmd, args), self.command_timeout)
+
+    async def aclose(self):
+        async with self._connect_lock:
+            await self._drop()
+
+    async def _execute_with_retry(self, cmd, args, retriable):
+        i = 0
+        while True:
+            try:
+                return await self._execute(cmd, args)
+            except Exception as e:
+                if i + 1 >= self.retry_count or not retriable(e) or _is_vm_unavailable(e):
+                    raise
+                logger.error("Failed to execute %s on %s: %s", cmd, self.socket_path, e)
+            # Exponential backoff with jitter
+            delay = min(self.retry_timeout * 2 ** i, self.retry_max_timeout) * random.uniform(0.5, 1.5)
+            i += 1
+            logger.info("Retrying %s in %.2f seconds", cmd, delay)
+            await asyncio.sleep(delay)
+
+    async def __aenter__(self):
+        await self._conn()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # Shared links from get() stay open for other tasks until close_all()
+        if self._links.get(self.socket_path) is not self:
+            await self.aclose()
 
     async def wait_for_vm(self):
+        delay = 0.05
         while True:
             try:
                 status = await self.query_status()
@@ -20,217 +130,161 @@ class QEMULink:
                     logger.info("The VM is running")
                     break
                 else:
-                    logger.info(f"VM status: {status}")
+                    logger.info("VM status: %s", status)
             except Exception as e:
-                logger.error(f"Failed to query VM status: {e}")
-            await asyncio.sleep(1)
+                logger.error("Failed to query VM status: %s", e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1)
 
     async def query_commands(self):
-        qmp = QMPClient()
         try:
-            await qmp.connect(self.socket_path)
-            res = await qmp.execute("query-commands")
-            logger.info("QMP Commands:")
-            for x in res:
-                logger.info(x)
+            res = await self._execute("query-commands")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("QMP supports %d commands: %s", len(res), ", ".join(x['name'] for x in res))
         except Exception as e:
-            logger.error(f"Failed to get a list of commands: {e}")
-        finally:
-            await qmp.disconnect()
+            logger.error("Failed to get a list of commands: %s", e)
 
     async def usb(self):
         ids = []
-        qmp = QMPClient()
         try:
-            await qmp.connect(self.socket_path)
-            res = await qmp.execute("human-monitor-command", {"command-line": "info usb"})
-            logger.debug(f"Guest USB Devices:")
-            for line in res.splitlines():
-                logger.debug(f"{line}")
-                id_pattern = re.compile(r',\sID:\s(\w+)')
-                match = id_pattern.search(line)
-                if match:
-                    ids.append(match.group(1))
+            res = await self._execute("human-monitor-command", {"command-line": "info usb"})
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Guest USB Devices:")
+                for line in res.splitlines():
+                    logger.debug("%s", line)
+            ids = usb_id_pattern.findall(res)
         except Exception as e:
-            logger.error(f"Failed to get a list of USB guest devices: {e}")
-        finally:
-            await qmp.disconnect()
+            logger.error("Failed to get a list of USB guest devices: %s", e)
         return ids
 
     async def usbhost(self):
-        qmp = QMPClient()
         try:
-            await qmp.connect(self.socket_path)
-            res = await qmp.execute("human-monitor-command", {"command-line": "info usbhost"})
-            logger.info(f"Host USB Devices:")
-            for line in res.splitlines():
-                logger.info(f"{line}")
+            res = await self._execute("human-monitor-command", {"command-line": "info usbhost"})
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Host USB Devices:")
+                for line in res.splitlines():
+                    logger.info("%s", line)
         except Exception as e:
-            logger.error(f"Failed to get a list of USB host devices: {e}")
-        finally:
-            await qmp.disconnect()
+            logger.error("Failed to get a list of USB host devices: %s", e)
 
     async def query_status(self):
-        qmp = QMPClient()
         try:
-            await qmp.connect(self.socket_path)
-            res = await qmp.execute("query-status")
+            res = await self._execute("query-status")
             return res['status']
-        except:
-            pass
-        finally:
-            await qmp.disconnect()
+        except (QMPError, OSError, EOFError, KeyError) as e:
+            logger.error("Failed to query VM status: %s", e)
+            return None
 
     async def query_pci(self):
-        qmp = QMPClient()
         try:
-            await qmp.connect(self.socket_path)
-            res = await qmp.execute("query-pci")
-            logger.info("Guest PCI Devices:")
+            res = await self._execute("query-pci")
+            if not logger.isEnabledFor(logging.INFO):
+                return
+            debug = logger.isEnabledFor(logging.DEBUG)
+            lines = ["Guest PCI Devices:"]
             for x in res:
                 for dev in x['devices']:
                     class_info = dev['class_info']
-                    logger.info(f"  Description: {class_info.get('desc')}. Class: {class_info.get('class')}. Bus: {dev['bus']}. Slot {dev['slot']}.")
-                    logger.debug(dev)
+                    lines.append(f"  Description: {class_info.get('desc')}. Class: {class_info.get('class')}. Bus: {dev['bus']}. Slot {dev['slot']}.")
+                    if debug:
+                        lines.append(f"  {dev}")
+            logger.info("\n".join(lines))
         except Exception as e:
-            logger.error(f"Failed to query PCI: {e}")
-        finally:
-            await qmp.disconnect()
+            logger.error("Failed to query PCI: %s", e)
+
+    def usb_address(self, device):
+        prop = device.properties.get
+        return int(prop("BUSNUM")), int(prop("DEVNUM"))
+
+    def id_for_usb_address(self, busnum, devnum):
+        # The separator keeps e.g. bus 1 device 23 and bus 12 device 3 apart
+        return f"usb{busnum}-{devnum}"
 
     def id_for_usb(self, device):
-        busnum = int(device.properties.get("BUSNUM"))
-        devnum = int(device.properties.get("DEVNUM"))
-        return f"usb{busnum}{devnum}"
+        return self.id_for_usb_address(*self.usb_address(device))
 
     async def add_usb_device(self, device):
-        busnum = int(device.properties.get("BUSNUM"))
-        devnum = int(device.properties.get("DEVNUM"))
-        qemuid = self.id_for_usb(device)
-        i = 0
-        while True:
-            qmp = QMPClient()
-            try:
-                await qmp.connect(self.socket_path)
-                logger.debug(f"Adding USB device with id {qemuid} to {self.socket_path}")
-                res = await qmp.execute("device_add", {"driver": "usb-host", "hostbus": busnum, "hostaddr": devnum, "id": qemuid})
-                if res:
-                    logger.error(f"Failed to add device {qemuid}: {res}")
-                else:
-                    logger.info(f"Attached USB device: {qemuid}")
-                return
-            except Exception as e:
-                if str(e).startswith("Duplicate device ID"):
-                    logger.info(f"USB device {qemuid} is already attached to the VM")
-                    return
-                else:
-                    logger.error(f"Failed to add USB device {qemuid}: {e}")
-                    i += 1
-            finally:
-                await qmp.disconnect()
-
-            if i < self.retry_count:
-                logger.info(f"Retrying")
-                await asyncio.sleep(self.retry_timeout)
+        busnum, devnum = self.usb_address(device)
+        qemuid = self.id_for_usb_address(busnum, devnum)
+        try:
+            logger.debug("Adding USB device with id %s to %s", qemuid, self.socket_path)
+            res = await self._execute_with_retry("device_add", {"driver": "usb-host", "hostbus": busnum, "hostaddr": devnum, "id": qemuid},
+                lambda e: not _is_duplicate_id(e))
+            if res:
+                logger.error("Failed to add device %s: %s", qemuid, res)
+            else:
+                logger.info("Attached USB device: %s", qemuid)
+        except Exception as e:
+            if _is_duplicate_id(e):
+                logger.info("USB device %s is already attached to the VM", qemuid)
             else:
-                break
-        logger.error(f"Failed to add USB device: {qemuid}")
+                logger.error("Failed to add USB device %s: %s", qemuid, e)
 
     async def add_usb_device_by_vid_pid(self, device, vid, pid):
         qemuid = self.id_for_usb(device)
-        i = 0
-        while True:
-            qmp = QMPClient()
-            try:
-                await qmp.connect(self.socket_path)
-                logger.debug(f"Adding USB device {vid}:{pid} with id {qemuid} to {self.socket_path}")
-                res = await qmp.execute("device_add", {"driver": "usb-host", "vendorid": vid, "productid": pid, "id": qemuid})
-                if res:
-                    logger.error(f"Failed to add device {vid}:{pid} with id {qemuid}: {res}")
-                else:
-                    logger.info(f"Attached USB device {vid}:{pid} with id {qemuid}")
-                return
-            except Exception as e:
-                if str(e).startswith("Duplicate device ID"):
-                    logger.info(f"USB device {vid}:{pid} with id {qemuid} is already attached to the VM")
-                    return
-                else:
-                    logger.error(f"Failed to add USB device {vid}:{pid} with id {qemuid}: {e}")
-                    i += 1
-            finally:
-                await qmp.disconnect()
-
-            if i < self.retry_count:
-                logger.info(f"Retrying")
-                await asyncio.sleep(self.retry_timeout)
+        try:
+            logger.debug("Adding USB device %s:%s with id %s to %s", vid, pid, qemuid, self.socket_path)
+            res = await self._execute_with_retry("device_add", {"driver": "usb-host", "vendorid": vid, "productid": pid, "id": qemuid},
+                lambda e: not _is_duplicate_id(e))
+            if res:
+                logger.error("Failed to add device %s:%s with id %s: %s", vid, pid, qemuid, res)
+            else:
+                logger.info("Attached USB device %s:%s with id %s", vid, pid, qemuid)
+        except Exception as e:
+            if _is_duplicate_id(e):
+                logger.info("USB device %s:%s with id %s is already attached to the VM", vid, pid, qemuid)
             else:
-                break
-        logger.error(f"Failed to add USB device {vid}:{pid} with id {qemuid}")
+                logger.error("Failed to add USB device %s:%s with id %s: %s", vid, pid, qemuid, e)
 
-    async def remove_usb_device(self, device):
-        qmp = QMPClient()
-        try:
-            await qmp.connect(self.socket_path)
+    async def remove_usb_device(self, device, qemuid=None):
+        if qemuid is None:
             qemuid = self.id_for_usb(device)
-            res = await qmp.execute("device_del", {"id": qemuid})
+        try:
+            res = await self._execute("device_del", {"id": qemuid})
             if res:
-                logger.error(f"Failed to remove USB device {qemuid}: {res}")
+                logger.error("Failed to remove USB device %s: %s", qemuid, res)
             else:
-                logger.info(f"Removed USB device {qemuid} from {self.socket_path}")
+                logger.info("Removed USB device %s from %s", qemuid, self.socket_path)
         except Exception as e:
-            if str(e) == f"Device '{qemuid}' not found":
-                logger.debug(f"Failed to remove USB device {qemuid} from {self.socket_path}: {e}")
+            if _is_device_not_found(e):
+                logger.debug("Failed to remove USB device %s from %s: %s", qemuid, self.socket_path, e)
             else:
-                logger.error(f"Failed to remove USB device {qemuid} from {self.socket_path}: {e}")
-        finally:
-            await qmp.disconnect()
+                logger.error("Failed to remove USB device %s from %s: %s", qemuid, self.socket_path, e)
 
     async def add_evdev_device(self, device, bus):
+        device_node = device.device_node
+        sys_name = device.sys_name
         idindex = 0
-        i = 0
         while True:
-            qemuid = device.sys_name
+            qemuid = sys_name
             if idindex > 0:
                 qemuid += f"-{idindex}"
-            logger.debug(f"Adding evdev device {device.device_node} with id {qemuid} to bus {bus}")
-            qmp = QMPClient()
+            logger.debug("Adding evdev device %s with id %s to bus %s", device_node, qemuid, bus)
             try:
-                await qmp.connect(self.socket_path)
-                res = await qmp.execute("device_add", {"driver": "virtio-input-host-pci", "evdev": device.device_node, "id": qemuid, "bus": bus})
+                res = await self._execute_with_retry("device_add", {"driver": "virtio-input-host-pci", "evdev": device_node, "id": qemuid, "bus": bus},
+                    lambda e: not _is_duplicate_id(e) and not _is_device_busy(e))
                 if res:
-                    logger.error(f"Failed to add evdev device to bus {bus}: {res}")
+                    logger.error("Failed to add evdev device to bus %s: %s", bus, res)
                 else:
-                    logger.info(f"Attached evdev device {device.device_node} to bus {bus}")
-                    return
+                    logger.info("Attached evdev device %s to bus %s", device_node, bus)
+                return
             except Exception as e:
-                if str(e).startswith("Duplicate device ID"):
+                if _is_duplicate_id(e):
                     idindex += 1
-                elif str(e).endswith("Device or resource busy"):
+                elif _is_device_busy(e):
                     logger.info("The device is busy, it is likely already connected to the VM")
                     return
                 else:
-                    logger.error(f"Failed to add evdev device to bus {bus}: {e}")
-                    i += 1
-            finally:
-                await qmp.disconnect()
-
-            if i < self.retry_count:
-                logger.info(f"Retrying")
-                await asyncio.sleep(self.retry_timeout)
-            else:
-                break
-        logger.error(f"Failed to add evdev device: {device.device_node}")
+                    logger.error("Failed to add evdev device %s to bus %s: %s", device_node, bus, e)
+                    return
 
     async def remove_evdev_device(self, device):
-        logger.debug(f"Removing evdev device {device.device_node} with id {device.sys_name}")
-        qmp = QMPClient()
+        logger.debug("Removing evdev device %s with id %s", device.device_node, device.sys_name)
         try:
-            await qmp.connect(self.socket_path)
-            res = await qmp.execute("device_del", {"id": device.sys_name})
+            res = await self._execute("device_del", {"id": device.sys_name})
             if res:
-                logger.error(f"Failed to remove evdev device: {res}")
+                logger.error("Failed to remove evdev device: %s", res)
             else:
-                logger.debug(f"Removed evdev device {device.sys_name}")
+                logger.debug("Removed evdev device %s", device.sys_name)
         except Exception as e:
-            logger.error(f"Failed to remove evdev device: {e}")
-        finally:
-            await qmp.disconnect()
+            logger.error("Failed to remove evdev device: %s", e)
@@ -8,25 +8,49 @@ from vhotplug.device import *
 from vhotplug.config import *
 from vhotplug.filewatcher import *
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 logger = logging.getLogger("vhotplug")
 
 async def device_event(context, config, device):
     if device.action == 'add':
-        logger.debug(f"Device plugged: {device.sys_name}.")
-        logger.debug(f"Subsystem: {device.subsystem}, path: {device.device_path}")
-        log_device(device)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Device plugged: %s.", device.sys_name)
+            logger.debug("Subsystem: %s, path: %s", device.subsystem, device.device_path)
+            log_device(device)
         if is_usb_device(device):
             vid, pid, vendor_name, product_name, interfaces = get_usb_info(device)
-            logger.info(f"USB device {vid}:{pid} connected: {device.device_node}")
-            logger.info(f'Vendor: "{vendor_name}", product: "{product_name}", interfaces: "{interfaces}"')
+            logger.info("USB device %s:%s connected: %s", vid, pid, device.device_node)
+            logger.info('Vendor: "%s", product: "%s", interfaces: "%s"', vendor_name, product_name, interfaces)
             await attach_usb_device(context, config, device)
     elif device.action == 'remove':
-        logger.debug(f"Device unplugged: {device.sys_name}.")
-        logger.debug(f"Subsystem: {device.subsystem}, path: {device.device_path}")
-        log_device(device)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Device unplugged: %s.", device.sys_name)
+            logger.debug("Subsystem: %s, path: %s", device.subsystem, device.device_path)
+            log_device(device)
         if is_usb_device(device):
-            logger.info(f"USB device disconnected: {device.device_node}")
+            logger.info("USB device disconnected: %s", device.device_node)
             await remove_usb_device(config, device)
+        forget_device(device)
+
+async def device_events(context, config, devices):
+    # Events for the same device are handled in order, different devices concurrently
+    events_by_path = {}
+    for device in devices:
+        events = events_by_path.setdefault(device.sys_path, [])
+        # Repeated events with the same action would only send duplicate QMP commands
+        if events and events[-1].action == device.action:
+            continue
+        events.append(device)
+
+    async def handle_events(events):
+        for device in events:
+            await device_event(context, config, device)
+
+    await asyncio.gather(*(handle_events(events) for events in events_by_path.values()))
 
 async def async_main():
     parser = argparse.ArgumentParser(description="Hot-plugging USB devices to the virtual machines")
@@ -44,7 +68,7 @@ async def async_main():
         logger.setLevel(logging.INFO)
 
     if not os.path.exists(args.config):
-        logger.error(f"Configuration file {args.config} not found")
+        logger.error("Configuration file %s not found", args.config)
         return
 
     config = Config(args.config)
@@ -54,26 +78,62 @@ async def async_main():
         await attach_connected_devices(context, config)
 
     monitor = pyudev.Monitor.from_netlink(context)
+    # USB devices are attached and removed, partitions and input devices are
+    # only needed to evict cached lookups
+    monitor.filter_by("usb", device_type="usb_device")
+    monitor.filter_by("block", device_type="partition")
+    monitor.filter_by("input")
+    monitor.start()
 
     watcher = FileWatcher()
     for vm in config.get_all_vms():
         qmp_socket = vm.get("qmpSocket")
         watcher.add_file(qmp_socket)
 
+    # A list of devices for udev events or None when a VM restart is detected
+    pending = asyncio.Queue()
+
+    def monitor_ready():
+        devices = []
+        while True:
+            device = monitor.poll(timeout=0)
+            if device == None:
+                break
+            devices.append(device)
+        if devices:
+            pending.put_nowait(devices)
+
+    def watcher_ready():
+        if watcher.detect_restart() == True and args.attach_connected:
+            pending.put_nowait(None)
+
+    loop = asyncio.get_running_loop()
+    loop.add_reader(monitor.fileno(), monitor_ready)
+    loop.add_reader(watcher.fileno(), watcher_ready)
+
     logger.info("Waiting for new devices")
     try:
         while True:
-            device = monitor.poll(timeout=1)
-            if device != None:
-                await device_event(context, config, device)
-            if watcher.detect_restart() == True and args.attach_connected:
-                    await attach_connected_devices(context, config)
+            devices = await pending.get()
+            if devices == None:
+                await attach_connected_devices(context, config)
+            else:
+                await device_events(context, config, devices)
+    finally:
+        loop.remove_reader(monitor.fileno())
+        loop.remove_reader(watcher.fileno())
+        await QEMULink.close_all()
 
+def main():
+    try:
+        if uvloop and hasattr(uvloop, "run"):
+            uvloop.run(async_main())
+        else:
+            if uvloop:
+                # uvloop.run() is only available since uvloop 0.18
+                uvloop.install()
+            asyncio.run(async_main())
     except KeyboardInterrupt:
         logger.info("Ctrl+C")
 
     logger.info("Exiting")
-
-def main():
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(async_main())